@@ -4,10 +4,44 @@
 
 ### Importing libraries
 import numpy as np
+import math
+import os
 import datetime
+import functools
+import contextlib
+import multiprocessing
+import concurrent.futures
 import scipy.optimize
 import matplotlib.pyplot as plt
 
+### Numba is optional, the NumPy versions of the kernels are used without it
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+### Numexpr is optional, it fuses the array expressions of the maps and scores
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+### CuPy is optional, it can score the e_best grid on the GPU, but only if
+### there is a GPU to use
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+if cp is not None:
+    try:
+        if cp.cuda.runtime.getDeviceCount() == 0:
+            cp = None
+    except cp.cuda.runtime.CUDARuntimeError:
+        cp = None
+
+### Worker processes are spawned rather than forked, as forking once Numba's
+### threads have started can leave the workers, and the interpreter, hung
+MP_CONTEXT = multiprocessing.get_context('spawn')
 
 
 #########################
@@ -17,57 +51,106 @@ import matplotlib.pyplot as plt
 ### ROTATE
 ### Rotates co-ordinates around a centre point by an angle
 def rotate(i, j, x_m, y_m, rot):
-    x = i*np.cos(np.radians(rot)) - j*np.sin(np.radians(rot)) - x_m*np.cos(np.radians(rot)) + y_m*np.sin(np.radians(rot))
-    y = j*np.cos(np.radians(rot)) + i*np.sin(np.radians(rot)) - y_m*np.cos(np.radians(rot)) - x_m*np.sin(np.radians(rot))
+    cos_rot = math.cos(math.radians(rot))
+    sin_rot = math.sin(math.radians(rot))
+    return rotate_pre(i, j, x_m, y_m, cos_rot, sin_rot)
+
+### ROTATE WITH PRECOMPUTED TRIGONOMETRY
+### Rotates co-ordinates around a centre point, given the cosine and sine
+### of the angle.
+def rotate_pre(i, j, x_m, y_m, cos_rot, sin_rot):
+    x = i*cos_rot - j*sin_rot - x_m*cos_rot + y_m*sin_rot
+    y = j*cos_rot + i*sin_rot - y_m*cos_rot - x_m*sin_rot
     return x, y
 
+### PIXEL GRID
+### Returns the row and column indices of an image of the given shape, as
+### arrays that broadcast against each other. These are cached, as the
+### optimisers ask for the same shape on every call.
+@functools.lru_cache(maxsize=8)
+def _grid(shape):
+    i = np.arange(shape[0])[:, None]
+    j = np.arange(shape[1])[None, :]
+    i.flags.writeable = False
+    j.flags.writeable = False
+    return i, j
+
 ### HYPERBOLIC SCALING
 ### Takes a set of data, beta value, and upper and lower limits, and scales
 ### the data with a hyperbolic function.
 def hyperbolic(data, beta, vu, vl):
-    return (np.arcsinh((data - vl)/beta))/(np.arcsinh((vu - vl)/beta))  
+    # Scaling in place in a single output array, leaving data as it was
+    data = np.asarray(data)
+    scaled = np.array(data, dtype=np.result_type(data, vl, 0.0), copy=True)
+    scaled -= vl
+    scaled /= beta
+    np.arcsinh(scaled, out=scaled)
+    scaled /= np.arcsinh((vu - vl)/beta)
+    # A single value is returned as a number rather than a 0-d array
+    return scaled[()]
 
 ### DEPROJECTION
 ### Takes a set of data, and stretches this depending on the inclination,
 ### resulting in it being deprojected.
 def deproject(data, inc):
     w = len(data[0])
-    h = len(data)
-    inc = np.radians(inc)
+    cos_inc = math.cos(math.radians(inc))
     
-    new_w = np.int(w/np.cos(inc))
-    new_data = np.zeros((h, new_w))
+    new_w = int(w/cos_inc)
     print(new_w)
-    for i in range(0, h):
-        for j in range(0, new_w):
-
-            new_data[i, j] = data[i, np.int(j*np.cos(inc))]
+    
+    # Each new column is taken from the column it is stretched out of
+    cols = np.minimum((np.arange(new_w)*cos_inc).astype(int), w - 1)
+    # Floating point data keeps its precision, so float32 images stay float32
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(float)
+    new_data = data[:, cols]
             
     return new_data
 
 ### CUT REGION
 ### Sets an elliptical region in a dataset to the value chosen.
 def cut(r, inc, rot, x_m, y_m, val, data):
-    w = len(data[0])
-    h = len(data)
-    for i in range(0, w):
-        for j in range(0, h):
-            x, y = rotate(i, j, x_m, y_m, rot)
-            R = np.sqrt(pow(x/np.cos(np.radians(inc)), 2) + pow(y, 2))
-            if (R < r):
-                data[i, j] = val
+    i, j = _grid((len(data), len(data[0])))
+    cos_inc = math.cos(math.radians(inc))
+    x, y = rotate(i, j, x_m, y_m, rot)
+    x = x/cos_inc
+    # Comparing squared radii, as no pixel is inside a negative radius
+    if r > 0:
+        data[x*x + y*y < r*r] = val
     return data            
 
+### GAUSSIAN RING BAND
+### Finds the pixels within RING_CUT standard deviations of a Gaussian ring of
+### radius r and thickness th, and the ring's profile at those pixels.
+### Outside of this band the profile is negligible, so the map builders
+### leave those pixels at the background.
+RING_CUT = 8
+
+def _ring_band(R, r, th):
+    band = np.abs(R - r) < RING_CUT*abs(th/2)
+    if ne is not None:
+        ring = ne.evaluate('exp(-(R - r)**2/(2*s2))',
+                           local_dict={'R': R[band], 'r': r, 's2': (th/2)*(th/2)})
+    else:
+        d = R[band] - r
+        ring = np.exp(-(d*d)/(2*(th/2)*(th/2)))
+    return band, ring
+
 ### TEST MAP
 ### Creates a map of an artificial ring using input parameters, in order to
 ### test fitting methods on.
 def test_map(r, th, inc, rot, x_m, y_m, surf, back, size):
-    test_map = np.full((size, size), back)
-    for i in range(size):
-        for j in range(size):
-            x, y = rotate(i, j, x_m, y_m, rot)
-            R = np.sqrt(pow(x/np.cos(np.radians(inc)), 2) + pow(y, 2))
-            test_map[i,j] = back + surf*np.exp((-pow(R - r, 2))/(2*pow(th/2, 2)))
+    i, j = _grid((size, size))
+    cos_inc = math.cos(math.radians(inc))
+    x, y = rotate(i, j, x_m, y_m, rot)
+    x = x/cos_inc
+    R = np.sqrt(x*x + y*y)
+    
+    band, ring = _ring_band(R, r, th)
+    test_map = np.full((size, size), back, dtype=float)
+    test_map[band] += surf*ring
             
     return test_map
 
@@ -75,77 +158,240 @@ def test_map(r, th, inc, rot, x_m, y_m, surf, back, size):
 ### Creates a map of an artificial ring with consideration of Mie scattering 
 ### using input parameters in order to test fitting methods on.
 def test_map_mie(r, th, inc, rot, x_m, y_m, surf_0, surf_theta, theta_max, back, size):
-    test_map = np.full((size, size), back)
-    for i in range(size):
-        for j in range(size):
-            x, y = rotate(i, j, x_m, y_m, rot)
+    i, j = _grid((size, size))
+    cos_inc = math.cos(math.radians(inc))
+    x, y = rotate(i, j, x_m, y_m, rot)
+    x = x/cos_inc
             
-            R = np.sqrt(pow(x/np.cos(np.radians(inc)), 2) + pow(y, 2))
-            theta = np.arctan2(i - x_m, j - y_m)
-            surf = surf_0 + surf_theta*pow(np.cos(0.5*(np.radians(theta_max) - theta + np.pi)), 2)
+    R = np.sqrt(x*x + y*y)
+    band, ring = _ring_band(R, r, th)
+    
+    # The surface brightness is only needed within the ring
+    i, j = np.nonzero(band)
+    theta = np.arctan2(i - x_m, j - y_m)
+    cos_theta = np.cos(0.5*(math.radians(theta_max) - theta + np.pi))
+    surf = surf_0 + surf_theta*cos_theta*cos_theta
             
-            test_map[i,j] = back + surf*np.exp((-pow(R - r, 2))/(2*pow(th/2, 2)))
+    test_map = np.full((size, size), back, dtype=float)
+    test_map[band] += surf*ring
             
     return test_map
 
 def hg_map(r, th, inc, rot, x_m, y_m, g, surf, back, size):
-    hg_map = np.full((size, size), back, dtype=float)
-    inc = np.radians(inc)
+    cos_inc = math.cos(math.radians(inc))
+    tan_inc = math.tan(math.radians(inc))
+    i, j = _grid((size, size))
 
-    for i in range(size):
-        for j in range(size):
-            x, y = rotate(i, j, x_m, y_m, rot)
-            R = np.sqrt(pow(x, 2) + pow(y/np.cos(inc), 2))
+    x, y = rotate(i, j, x_m, y_m, rot)
+    R = np.sqrt(x*x + y*y/(cos_inc*cos_inc))
+    band, ring = _ring_band(R, r, th)
+    
+    # The scattering is only needed within the ring
+    x = x[band]
+    y = y[band]
             
-            z = -y*np.tan(inc)
-            mod = np.sqrt(pow(x,2)+pow(y,2)+pow(z,2))
+    z = -y*tan_inc
+    mod = np.sqrt(x*x + y*y + z*z)
             
-            if (mod == 0):
-                op_vec = 0
-            else:
-                op_vec = -z/mod
+    # The scattering angle is undefined at the centre, where mod is zero
+    op_vec = np.divide(-z, mod, out=np.zeros_like(mod), where=(mod != 0))
   
-            p = (1-pow(g,2))/(4*np.pi*pow(1+pow(g,2)+2*g*op_vec,1.5))
+    p = (1 - g*g)/(4*np.pi*pow(1 + g*g + 2*g*op_vec, 1.5))
             
-            hg_map[i,j] = back + surf*p*np.exp((-pow(R - r, 2))/(2*pow(th/2, 2)))
+    hg_map = np.full((size, size), back, dtype=float)
+    hg_map[band] += surf*p*ring
     
     return hg_map
 
+### ABSOLUTE RESIDUAL
+### Returns the sum of the absolute differences between the data and a map.
+def _residual(data, map):
+    if ne is not None:
+        return float(ne.evaluate('sum(abs(data - map))'))
+    return float(np.abs(data - map).sum())
+
 ### ADD NOISE
-### Adds Poissonian noise to an image
-def add_noise(data, n):
+### Adds Poissonian noise to an image. The noise is drawn from rng if one is
+### given, such as a np.random.default_rng(seed), and otherwise from NumPy's
+### global generator, so that np.random.seed makes it reproducible.
+def add_noise(data, n, rng=None):
+    if rng is None:
+        rng = np.random
     noise = data
-    for i in range(n):   
-        noise = np.random.poisson(np.abs(noise))
+    for i in range(n):
+        noise = rng.poisson(np.abs(noise))
     return noise
 
 #########################
 ### ELLIPSE FUNCTIONS ###
 #########################
 
+### ELLIPSE ANGLES
+### Returns the angles at which to sample an ellipse so that every pixel it
+### passes through is sampled. Each of the ellipse's offsets from its centre
+### is R*cos(t - phi), so the angles at which it crosses a pixel edge can be
+### solved for, and the midpoints between them each lie inside one pixel.
+def e_angles(r, cos_inc, cos_rot, sin_rot):
+    R_x = math.hypot(r*cos_rot, r*cos_inc*sin_rot)
+    phi_x = math.atan2(-r*cos_inc*sin_rot, r*cos_rot)
+    R_y = math.hypot(r*sin_rot, r*cos_inc*cos_rot)
+    phi_y = math.atan2(r*cos_inc*cos_rot, r*sin_rot)
+    
+    # The offsets are truncated to find the pixels, so the pixel edges are
+    # at every integer but 0. An edge the ellipse only touches still splits
+    # the arc either side of it.
+    k_x = np.arange(1, math.floor(R_x) + 1)
+    k_x = np.concatenate((k_x, -k_x))/R_x
+    k_y = np.arange(1, math.floor(R_y) + 1)
+    k_y = np.concatenate((k_y, -k_y))/R_y
+    edges = np.concatenate((phi_x + np.arccos(k_x), phi_x - np.arccos(k_x),
+                            phi_y + np.arccos(k_y), phi_y - np.arccos(k_y)))
+    edges = np.sort(np.mod(edges, 2*np.pi))
+    
+    # An ellipse crossing no pixel edges lies within one pixel
+    if edges.size == 0:
+        return np.zeros(1)
+    
+    # Where the ellipse passes through a pixel corner, or touches an edge,
+    # two edges' angles are the same up to rounding, with no pixel between
+    ends = np.concatenate((edges[1:], edges[:1] + 2*np.pi))
+    arc = ends - edges > 1e-9
+    if not arc.any():
+        return np.zeros(1)
+    return (edges[arc] + ends[arc])/2
+
+if njit is not None:
+    _e_angles_nb = njit(cache=True)(e_angles)
+
+### COMPILED BEST FITTING ELLIPSE SEARCH
+### The scoring in e_best compiled with Numba, with each (r, inc, rot) scored
+### over all the centres by a separate thread. Each thread writes its own
+### part of score_list.
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _e_best_nb(r_min, inc, rot, x_m, y_m, data, score_list):
+        h, w = data.shape
+        n_r, n_inc, n_rot = score_list.shape[0], score_list.shape[1], score_list.shape[2]
+        for k in prange(n_r*n_inc*n_rot):
+            a = k//(n_inc*n_rot)
+            b = (k//n_rot) % n_inc
+            c = k % n_rot
+            r = r_min + a
+            cos_inc = np.cos(inc[b])
+            cos_rot = np.cos(rot[c])
+            sin_rot = np.sin(rot[c])
+            t = _e_angles_nb(float(r), cos_inc, cos_rot, sin_rot)
+            n = t.size
+            
+            # Sorting the ellipse's pixel offsets, as in e_best
+            shift = abs(r) + 1
+            size = 2*shift + 1
+            offsets = np.empty(n, dtype=np.int64)
+            for s in range(n):
+                Ell_x = r*np.cos(t[s])
+                Ell_y = r*cos_inc*np.sin(t[s])
+                d_x = int(cos_rot*Ell_x - sin_rot*Ell_y)
+                d_y = int(sin_rot*Ell_x + cos_rot*Ell_y)
+                offsets[s] = (d_y + shift)*size + (d_x + shift)
+            offsets.sort()
+            
+            # Scoring every centre, counting each pixel once and leaving out
+            # those off the image
+            for e in range(x_m.size):
+                for f in range(y_m.size):
+                    score = 0.0
+                    for s in range(n):
+                        if s == 0 or offsets[s] != offsets[s - 1]:
+                            sq_x = x_m[e] + offsets[s] % size - shift
+                            sq_y = y_m[f] + offsets[s]//size - shift
+                            if sq_x >= 0 and sq_x < w and sq_y >= 0 and sq_y < h:
+                                score += data[sq_y, sq_x]
+                    score_list[a, b, c, e, f] = score
+else:
+    _e_best_nb = None
+
 ### BEST FITTING ELLIPSE SEARCH
 ### Searches through all ellipses in the given ranges for parameters,
-### returning the best scoring one.
-def e_best(r_min, r_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, data):
+### returning the best scoring one. If gpu is set, and CuPy has a GPU to
+### use, the ellipses are scored on the GPU.
+def e_best(r_min, r_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, data, gpu=False):
     
     # Initialising the score array
     score_list = np.zeros((r_max - r_min, inc_max - inc_min,
                            rot_max - rot_min, x_m_max - x_m_min,
                            y_m_max - y_m_min))
     
-    # Iterating over all values of r, inc, rot, x_m, and y_m
-    for r in range(r_min, r_max):
-        # Printing time and progress
-        print(datetime.datetime.now(), "--->", (r - r_min)/(r_max - r_min) * 100, "%")
-        for inc in range(inc_min, inc_max):
-            for rot in range(rot_min, rot_max):
-                for x_m in range(x_m_min, x_m_max):
-                    for y_m in range(y_m_min, y_m_max):
-                        # Adding this ellipse's score to the score array
-                        this_score = e_score(r, inc, rot, x_m, y_m, data)
-                        score_list[r - r_min, inc - inc_min,
-                                    rot - rot_min, x_m - x_m_min,
-                                    y_m - y_m_min] = this_score
+    # Parameter values along each axis
+    inc = np.radians(np.arange(inc_min, inc_max))
+    rot = np.radians(np.arange(rot_min, rot_max))
+    x_m = np.arange(x_m_min, x_m_max)
+    y_m = np.arange(y_m_min, y_m_max)
+    
+    gpu = gpu and cp is not None
+    
+    if _e_best_nb is not None and not gpu:
+        # Scoring every ellipse at once, across all threads
+        print(datetime.datetime.now(), "---> scoring", score_list.size, "ellipses")
+        _e_best_nb(r_min, inc, rot, x_m, y_m, data, score_list)
+    else:
+        # Scoring on the GPU if asked to, the data and the values are copied
+        # there once and only the scores are copied back
+        xp = cp if gpu else np
+        data = xp.asarray(data)
+        h, w = data.shape
+        
+        # Shaping the values to broadcast as [inc, rot, x_m, y_m, t]
+        inc_axis, rot_axis = inc, rot
+        inc = xp.asarray(inc)[:, None, None, None, None]
+        rot = xp.asarray(rot)[None, :, None, None, None]
+        x_m = xp.asarray(x_m)[None, None, :, None, None]
+        y_m = xp.asarray(y_m)[None, None, None, :, None]
+        
+        # Iterating over all values of r, scoring every inc, rot, x_m, and
+        # y_m at once
+        for r in range(r_min, r_max):
+            # Printing time and progress
+            print(datetime.datetime.now(), "--->", (r - r_min)/(r_max - r_min) * 100, "%")
+            
+            # Finding each ellipse's sample angles, padding the shorter ones
+            # by repeating their last angle, which is then scored only once
+            angles = [[e_angles(r, math.cos(inc_b), math.cos(rot_c), math.sin(rot_c))
+                       for rot_c in rot_axis] for inc_b in inc_axis]
+            n = max(a.size for row in angles for a in row)
+            t = np.empty((inc_axis.size, rot_axis.size, 1, 1, n))
+            for b, row in enumerate(angles):
+                for c, a in enumerate(row):
+                    t[b, c, 0, 0, :a.size] = a
+                    t[b, c, 0, 0, a.size:] = a[-1]
+            t = xp.asarray(t)
+            
+            # Rotating the ellipses, as in e_pixels
+            Ell_x = r*xp.cos(t)
+            Ell_y = r*xp.cos(inc)*xp.sin(t)
+            d_x = (xp.cos(rot)*Ell_x - xp.sin(rot)*Ell_y).astype(int)
+            d_y = (xp.sin(rot)*Ell_x + xp.cos(rot)*Ell_y).astype(int)
+            
+            # Sorting each ellipse's pixel offsets and flagging repeats, so
+            # that a pixel's score is only counted once, as in e_score. Which
+            # offsets repeat does not depend on the centre.
+            shift = abs(r) + 1
+            size = 2*shift + 1
+            offsets = xp.sort((d_y + shift)*size + (d_x + shift), axis=-1)
+            first = xp.ones(offsets.shape, dtype=bool)
+            first[..., 1:] = offsets[..., 1:] != offsets[..., :-1]
+            sq_x = x_m + offsets % size - shift
+            sq_y = y_m + offsets // size - shift
+            
+            # Leaving out the pixels off the image, as in e_score, which are
+            # clipped onto it only to be gathered
+            on = first & (sq_x >= 0) & (sq_x < w) & (sq_y >= 0) & (sq_y < h)
+            sq_x = xp.clip(sq_x, 0, w - 1)
+            sq_y = xp.clip(sq_y, 0, h - 1)
+            
+            # Adding these ellipses' scores to the score array, summed in
+            # double precision as in the compiled kernel
+            scores = (data[sq_y, sq_x]*on).sum(axis=-1, dtype=float)
+            score_list[r - r_min] = scores if xp is np else cp.asnumpy(scores)
     
     # Printing the maximum score
     print("Max score = ", np.max(score_list))
@@ -165,67 +411,96 @@ def e_best(r_min, r_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y
     
     return ell_params  
 
+### ELLIPSE PIXELS
+### Returns the pixel co-ordinates of the points at angles t around an
+### ellipse.
+def e_pixels(r, inc, rot, x_m, y_m, t):
+    
+    # Drawning an ellipse with this r, inc, rot, x_m, and y_m
+    cos_rot = math.cos(math.radians(rot))
+    sin_rot = math.sin(math.radians(rot))
+    Ell = np.array([r*np.cos(t), r*math.cos(math.radians(inc))*np.sin(t)])  
+    R_rot = np.array([[cos_rot, -sin_rot],
+                      [sin_rot, cos_rot]])
+    
+    # Rotating the ellipse
+    Ell_rot = R_rot @ Ell
+    
+    # Finding the pixels it passes through
+    sq_x = int(x_m) + Ell_rot[0].astype(int)
+    sq_y = int(y_m) + Ell_rot[1].astype(int)
+    
+    return sq_x, sq_y
+
 ### ELLIPSE MASK
 def e_mask(r, inc, rot, x_m, y_m, data):
     
-    # Initialising a mask and score    
+    # Initialising a mask
     mask = np.full((len(data), len(data[0])), 0)
-    mask_no = 0;
-                        
-    # Drawning an ellipse with this r, inc, rot, x_m, and y_m
-    t = np.linspace(0, 2*np.pi, 10000)
-    Ell = np.array([r*np.cos(t), r*np.cos(np.radians(inc))*np.sin(t)])  
-    R_rot = np.array([[np.cos(np.radians(rot)), -np.sin(np.radians(rot))],
-                      [np.sin(np.radians(rot)), np.cos(np.radians(rot))]])
-    Ell_rot = np.zeros((2,Ell.shape[1]))
-                        
-    for i in range(Ell.shape[1]):
-                            
-        # Rotating the ellipse
-        Ell_rot[:,i] = np.dot(R_rot,Ell[:,i])
-                            
-        # Producing the mask
-        sq_x = np.int(x_m) + np.int(Ell_rot[0,i])
-        sq_y = np.int(y_m) + np.int(Ell_rot[1,i])
-     
-        # Calculating the score
-        mask_no += 1
-        mask[sq_y, sq_x] += 1
+    
+    # Counting the number of times the ellipse passes through each pixel
+    sq_x, sq_y = e_pixels(r, inc, rot, x_m, y_m, np.linspace(0, 2*np.pi, 10000))
+    np.add.at(mask, (sq_y, sq_x), 1)
             
     return mask
 
+### COMPILED SCORE ELLIPSE
+### The ellipse drawing and scoring of e_score compiled with Numba. The
+### pixels are deduplicated by sorting their flat indices, so no image
+### sized mask is needed, and the GIL is released while it runs. Samples off
+### the image are left out, as in e_score.
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _e_score_nb(r, cos_inc, cos_rot, sin_rot, x_m, y_m, data):
+        h, w = data.shape
+        t = _e_angles_nb(r, cos_inc, cos_rot, sin_rot)
+        n = t.size
+        pixels = np.empty(n, dtype=np.int64)
+        for k in range(n):
+            Ell_x = r*np.cos(t[k])
+            Ell_y = r*cos_inc*np.sin(t[k])
+            sq_x = x_m + int(cos_rot*Ell_x - sin_rot*Ell_y)
+            sq_y = y_m + int(sin_rot*Ell_x + cos_rot*Ell_y)
+            # Samples off the image are marked with -1, and sort first
+            if sq_x >= 0 and sq_x < w and sq_y >= 0 and sq_y < h:
+                pixels[k] = sq_y*w + sq_x
+            else:
+                pixels[k] = -1
+        pixels.sort()
+        
+        score = 0.0
+        for k in range(n):
+            if pixels[k] >= 0 and (k == 0 or pixels[k] != pixels[k - 1]):
+                score += data[pixels[k] // w, pixels[k] % w]
+        return score
+else:
+    _e_score_nb = None
+
 ### SCORE ELLIPSE
-### Scores a particular ellipse on the data given.
+### Scores a particular ellipse on the data given. Any part of the ellipse
+### off the image does not add to its score.
 def e_score(r, inc, rot, x_m, y_m, data):
     
-    # Initialising a mask and score    
-    mask = np.full((len(data), len(data[0])), 0)
-    mask_no = 0;
-    score = 0;
-                        
-    # Drawning an ellipse with this r, inc, rot, x_m, and y_m
-    t = np.linspace(0, 2*np.pi, 400)
-    Ell = np.array([r*np.cos(t), r*np.cos(np.radians(inc))*np.sin(t)])  
-    R_rot = np.array([[np.cos(np.radians(rot)), -np.sin(np.radians(rot))],
-                      [np.sin(np.radians(rot)), np.cos(np.radians(rot))]])
-    Ell_rot = np.zeros((2,Ell.shape[1]))
-                        
-    for i in range(Ell.shape[1]):
-                            
-        # Rotating the ellipse
-        Ell_rot[:,i] = np.dot(R_rot,Ell[:,i])
-                            
-        # Producing the mask
-        sq_x = np.int(x_m) + np.int(Ell_rot[0,i])
-        sq_y = np.int(y_m) + np.int(Ell_rot[1,i])
-                            
-        # Checking to not count a pixel's score multiple times
-        if (mask[sq_y, sq_x] == 0):
-            mask_no += 1                  
-        # Calculating the score
-        score += data[sq_y, sq_x]
-    
-    return score
+    cos_inc = math.cos(math.radians(inc))
+    cos_rot = math.cos(math.radians(rot))
+    sin_rot = math.sin(math.radians(rot))
+    
+    if _e_score_nb is not None:
+        return _e_score_nb(float(r), cos_inc, cos_rot, sin_rot, int(x_m), int(y_m), data)
+    
+    # Sampling the ellipse once inside every pixel it passes through
+    t = e_angles(r, cos_inc, cos_rot, sin_rot)
+    sq_x, sq_y = e_pixels(r, inc, rot, x_m, y_m, t)
+    
+    # Leaving out the samples that fall off the image, and not counting a
+    # pixel's score multiple times
+    h, w = data.shape
+    on = (sq_x >= 0) & (sq_x < w) & (sq_y >= 0) & (sq_y < h)
+    pixels = np.unique(sq_y[on]*w + sq_x[on])
+    
+    # Calculating the score, gathering straight from the flat indices and
+    # summing in double precision as the compiled kernel does
+    return data.take(pixels).sum(dtype=float)
 
 ### RECIPROCAL SCORE ELLIPSE
 ### Finds the reciprocal of the score of an ellipse.
@@ -234,17 +509,38 @@ def e_r_score(init, data):
     # Finds the score of that ellipse
     score = e_score(r, inc, rot, x_m, y_m, data)
     # Returns the reciprocal of the score
+    if score == 0:
+        score = 0.001
     return 1/score
 
 ### OPTIMISED ELLIPSE
 ### Performs an optimised search for the best fitting ellipse, using the
-### parameters as a starting point.
-def e_opt(r, inc, rot, x_m, y_m, data):
+### parameters as a starting point. If plot is set, the ellipse is drawn
+### after every iteration.
+def e_opt(r, inc, rot, x_m, y_m, data, plot=False):
     init = (r, inc, rot, x_m, y_m)
+    if plot:
+        callback = lambda xk: e_plot(xk, 'purple')
+    else:
+        callback = None
+    
+    # The score only depends on the centre through the pixel it lies in, so
+    # the many centres Powell tries within one pixel are only scored once
+    @functools.lru_cache(maxsize=4096)
+    def score(r, inc, rot, x_m, y_m):
+        return e_score(r, inc, rot, x_m, y_m, data)
+    
+    def r_score(init):
+        r, inc, rot, x_m, y_m = init
+        s = score(r, inc, rot, int(x_m), int(y_m))
+        if s == 0:
+            s = 0.001
+        return 1/s
+    
     # Finds the minimum reciprocal scored ellipse
-    params = scipy.optimize.minimize(e_r_score, init, args = data,
+    params = scipy.optimize.minimize(r_score, init,
                                      method = 'Powell', tol = 1e-5,
-                                     callback=e_plot(init, 'purple'),
+                                     callback=callback,
                                      options={'disp':True})
     print(params['x'])
     return params['x']
@@ -255,7 +551,8 @@ def e_opt(r, inc, rot, x_m, y_m, data):
 def e_evo(r_min, r_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, data):
     init = [(r_min, r_max), (inc_min, inc_max), (rot_min, rot_max),
             (x_m_min, x_m_max), (y_m_min, y_m_max)]
-    params = scipy.optimize.differential_evolution(e_r_score, init, args = (data,), popsize=1000, tol=1e-8, mutation=(1,1.9), polish=True)
+    with MP_CONTEXT.Pool() as pool:
+        params = scipy.optimize.differential_evolution(e_r_score, init, args = (data,), popsize=1000, tol=1e-8, mutation=(1,1.9), polish=True, workers=pool.map, updating='deferred')
     print(params['x'])
     return params['x'] 
 
@@ -265,12 +562,12 @@ def e_plot(params, col):
     r, inc, rot, x_m, y_m = params
     t = np.linspace(0, 2*np.pi, 100)
     
-    Ell = np.array([r*np.cos(t), r*np.cos(np.radians(inc))*np.sin(t)])  
-    R_rot = np.array([[np.cos(np.radians(rot)), -np.sin(np.radians(rot))],
-                      [np.sin(np.radians(rot)), np.cos(np.radians(rot))]])
-    Ell_rot = np.zeros((2,Ell.shape[1]))
-    for i in range(Ell.shape[1]):
-        Ell_rot[:,i] = np.dot(R_rot,Ell[:,i])
+    cos_rot = math.cos(math.radians(rot))
+    sin_rot = math.sin(math.radians(rot))
+    Ell = np.array([r*np.cos(t), r*math.cos(math.radians(inc))*np.sin(t)])  
+    R_rot = np.array([[cos_rot, -sin_rot],
+                      [sin_rot, cos_rot]])
+    Ell_rot = R_rot @ Ell
     
     # Plotting the ellipse
     plt.plot(x_m + Ell_rot[0,:], y_m + Ell_rot[1,:], col)
@@ -284,30 +581,101 @@ def e_plot(params, col):
 ### ANNULUS Z FUNCTION
 ### Returns the radius of the ellipse at that point
 def a_z(i, j, inc, rot, x_m, y_m):
+    cos_inc = math.cos(math.radians(inc))
     x, y = rotate(i, j, x_m, y_m, rot)
-    z = np.sqrt((x)**2 + ((y)**2)/np.cos(np.radians(inc)))
+    z = np.sqrt(x*x + (y*y)/cos_inc)
     return z
 
+### SQUARED ANNULUS Z FUNCTION
+### Returns the square of a_z, given the cosines and sine of the angles, so
+### that no square root is needed when comparing it against a band.
+def _a_z_sq(i, j, cos_inc, cos_rot, sin_rot, x_m, y_m):
+    x, y = rotate_pre(i, j, x_m, y_m, cos_rot, sin_rot)
+    return x*x + (y*y)/cos_inc
+
+### SQUARED ANNULUS BAND
+### Returns bounds such that z_in_sq < z**2 < z_out_sq, with z**2 >= 0, is the
+### same test as r - th/2 < z < r + th/2. The inner bound is negative when
+### it lies inside the centre, and the band is empty if the outer one does.
+def _a_band_sq(r, th):
+    z_in = r - th/2
+    z_out = r + th/2
+    z_in_sq = z_in*z_in if z_in >= 0 else -1.0
+    z_out_sq = z_out*z_out if z_out > 0 else 0.0
+    return z_in_sq, z_out_sq
+
+### BEST FITTING ANNULUS SLAB
+### Scores every annulus in the given ranges for one value of inc, returning
+### the scores indexed as [r, th, rot, x_m, y_m]. This is kept at the top
+### level so that a_best can run it in separate processes.
+def _a_best_slab(inc, r_min, r_max, th_min, th_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, data):
+    
+    # Initialising the score array
+    slab = np.zeros((r_max - r_min, th_max - th_min, rot_max - rot_min, x_m_max - x_m_min, y_m_max - y_m_min))
+    
+    # Inner and outer edges of every (r, th) annulus, as in a_score
+    r = np.arange(r_min, r_max)[:, None]
+    th = np.maximum(np.arange(th_min, th_max), 1)[None, :]
+    z_in = r - th/2
+    z_out = r + th/2
+    
+    i, j = _grid((len(data), len(data[0])))
+    flat = data.ravel()
+    
+    # Iterating over all values of rot, x_m, and y_m, with the angles'
+    # cosines and sines found once per inc and rot rather than per centre
+    cos_inc = math.cos(math.radians(inc))
+    for rot in range(rot_min, rot_max):
+        cos_rot = math.cos(math.radians(rot))
+        sin_rot = math.sin(math.radians(rot))
+        for x_m in range(x_m_min, x_m_max):
+            for y_m in range(y_m_min, y_m_max):
+                
+                # Sorting the pixels by z, so that every annulus with this
+                # centre and shape is a contiguous run of pixels
+                z = np.sqrt(_a_z_sq(i, j, cos_inc, cos_rot, sin_rot, x_m, y_m)).ravel()
+                order = np.argsort(z)
+                z = z[order]
+                # Summing in double precision, as a_score does, whatever the
+                # precision of the data
+                cum = np.concatenate(([0], np.cumsum(flat[order], dtype=float)))
+                
+                # Scoring all values of r and th at once
+                start = np.searchsorted(z, z_in, side='right')
+                end = np.searchsorted(z, z_out, side='left')
+                mask_no = np.maximum(end - start, 1)
+                slab[:, :, rot - rot_min, x_m - x_m_min, y_m - y_m_min] = (cum[end] - cum[start])/mask_no
+    
+    return slab
+
 ### BEST FITTING ANNULUS SEARCH
 ### Searches through all annuli in the given ranges for parameters,
-### returning the best scoring one.
+### returning the best scoring one. Each value of inc is scored in its own
+### process, unless there is only one.
 def a_best(r_min, r_max, th_min, th_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, data):
     
     # Initialising the score array
     score_list = np.zeros((r_max - r_min, th_max - th_min, inc_max - inc_min, rot_max - rot_min, x_m_max - x_m_min, y_m_max - y_m_min))
     
-    # Iterating over all values of r, th, inc, rot, x_m, and y_m
-    for r in range(r_min, r_max):
-        for th in range(th_min, th_max):
+    # Scoring the slabs for all values of inc across all cores, and adding
+    # them to the score array as they finish
+    incs = range(inc_min, inc_max)
+    n = len(incs)
+    if n > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=MP_CONTEXT)
+    else:
+        pool = contextlib.nullcontext()
+    with pool as executor:
+        # A single slab is scored here, rather than starting a process for it
+        map_slabs = map if executor is None else executor.map
+        slabs = map_slabs(_a_best_slab, incs,
+                          [r_min]*n, [r_max]*n, [th_min]*n, [th_max]*n,
+                          [rot_min]*n, [rot_max]*n, [x_m_min]*n, [x_m_max]*n,
+                          [y_m_min]*n, [y_m_max]*n, [data]*n)
+        for inc, slab in zip(incs, slabs):
             # Printing time and progress
-            print(datetime.datetime.now(), "--->", ((r - r_min + (th - th_min)/(th_max - th_min)))/(r_max - r_min) * 100, "%")
-            for inc in range(inc_min, inc_max):
-                for rot in range(rot_min, rot_max):
-                    for x_m in range(x_m_min, x_m_max):
-                        for y_m in range(y_m_min, y_m_max):
-                            
-                            this_score = a_score(r, th, inc, rot, x_m, y_m, data)
-                            score_list[r - r_min, th - th_min, inc - inc_min, rot - rot_min, x_m - x_m_min, y_m - y_m_min] = this_score
+            print(datetime.datetime.now(), "--->", (inc - inc_min + 1)/(inc_max - inc_min) * 100, "%")
+            score_list[:, :, inc - inc_min] = slab
     
     # Printing the maximum score
     print("Max score = ", np.max(score_list))
@@ -328,28 +696,53 @@ def a_best(r_min, r_max, th_min, th_max, inc_min, inc_max, rot_min, rot_max, x_m
     
     return a_params
 
+### COMPILED SCORE ANNULUS
+### The loop in a_score compiled with Numba, which finds the mean of the
+### pixels in the annulus without building the z or mask arrays.
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _a_score_nb(z_in_sq, z_out_sq, cos_inc, cos_rot, sin_rot, x_m, y_m, data):
+        score = 0.0
+        mask_no = 0
+        for i in prange(data.shape[0]):
+            for j in range(data.shape[1]):
+                x = i*cos_rot - j*sin_rot - x_m*cos_rot + y_m*sin_rot
+                y = j*cos_rot + i*sin_rot - y_m*cos_rot - x_m*sin_rot
+                z_sq = x*x + y*y/cos_inc
+                if (z_sq >= 0 and z_sq > z_in_sq and z_sq < z_out_sq):
+                    score += data[i, j]
+                    mask_no += 1
+        if mask_no == 0:
+            mask_no = 1
+        return score/mask_no
+else:
+    _a_score_nb = None
+
 ### SCORE ANNULUS
 ### Scores a particular annulus on the data given.
 def a_score(r, th, inc, rot, x_m, y_m, data):
-    # Initialising a mask and score    
-    mask = np.full((len(data), len(data[0])), False)
-    mask_no = 0
-    score = 0
     if th < 1:
         th = 1
-                            
-    for i in range(0, 282):
-        for j in range(0, 282):
-            z = a_z(i, j, inc, rot, x_m, y_m)
-            if (z > r - th/2 and z < r + th/2):
-                if (mask[i,j] == False):
-                    # Calculating the score
-                    score +=  data[i, j]
-                    mask_no += 1
-                    mask[i,j] = True
+    z_in_sq, z_out_sq = _a_band_sq(r, th)
+    cos_inc = math.cos(math.radians(inc))
+    cos_rot = math.cos(math.radians(rot))
+    sin_rot = math.sin(math.radians(rot))
+    
+    if _a_score_nb is not None:
+        return _a_score_nb(z_in_sq, z_out_sq, cos_inc, cos_rot, sin_rot,
+                           float(x_m), float(y_m), data)
+    
+    # Finding the pixels that lie within the annulus
+    i, j = _grid((len(data), len(data[0])))
+    z_sq = _a_z_sq(i, j, cos_inc, cos_rot, sin_rot, x_m, y_m)
+    mask = (z_sq >= 0) & (z_sq > z_in_sq) & (z_sq < z_out_sq)
+    
+    # Calculating the mean score of those pixels, summed in double precision
+    # as the compiled kernel does
+    mask_no = mask.sum()
     if mask_no == 0:
         mask_no = 1
-    return score/mask_no
+    return data[mask].sum(dtype=float)/mask_no
 
 ### RECIPROCAL SCORE ANNULUS
 ### Finds the reciprocal of the score of an annulus.
@@ -376,34 +769,34 @@ def a_opt(r, th, inc, rot, x_m, y_m, data):
 ### SURFACE BRIGHTNESS ANNULUS MAP
 ### Returns a 2D array plotting an annulus of given parameters.
 def a_surf_map(r, th, inc, rot, x_m, y_m, surf, back, data):
-    map = np.full((len(data), len(data[0])), back)
-    for i in range (0, len(data)):
-        for j in range(0, len(data[0])):
-            z = a_z(i, j, inc, rot, x_m, y_m)
-            if (z > r - th/2 and z < r + th/2):
-                map[j, i] = surf
+    # The map is indexed [j, i], so the grid is used transposed
+    j, i = _grid((len(data), len(data[0])))
+    z = a_z(i, j, inc, rot, x_m, y_m)
+    map = np.full((len(data), len(data[0])), back, dtype=float)
+    map[(z > r - th/2) & (z < r + th/2)] = surf
     return map
 
 ### SURFACE BRIGHTNESS ANNULUS SCORE
 ### Returns the score of the data minus a surface brightness annulus map.
 def a_surf_score(init, data):
     r, th, inc, rot, x_m, y_m, surf, back = init
-    score = 0
     map = a_surf_map(r, th, inc, rot, x_m, y_m, surf, back, data)
-    for i in range (0, len(data)):
-        for j in range(0, len(data[0])):
-            score += np.sqrt((data[i,j] - map[i,j])**2)
-    return score
+    return _residual(data, map)
 
 ### OPTIMISED SURFACE BRIGHTNESS ANNULUS
 ### Performs an optimised algorithm search for the best fitting annulus
-### with a given surface brightness, in the range of parameters given.
-def a_surf_opt(r, th, inc, rot, x_m, y_m, surf, back, data):
+### with a given surface brightness, in the range of parameters given. If
+### plot is set, the annulus' centre line is drawn after every iteration.
+def a_surf_opt(r, th, inc, rot, x_m, y_m, surf, back, data, plot=False):
     init = (r, th, inc, rot, x_m, y_m, surf, back)
+    if plot:
+        callback = lambda xk: e_plot((xk[0], xk[2], xk[3], xk[4], xk[5]), 'k')
+    else:
+        callback = None
     # Finds the minimum difference between data and annulus
     params = scipy.optimize.minimize(a_surf_score, init, args = data,
                                      method = 'Powell', tol = 1e-5,
-                                     callback=e_plot((init[0], init[2], init[3], init[4], init[5]), 'k'),
+                                     callback=callback,
                                      options={'disp':True})
     print(params['x'])
     return params['x']
@@ -415,7 +808,8 @@ def a_surf_opt(r, th, inc, rot, x_m, y_m, surf, back, data):
 def a_surf_evo(r_min, r_max, th_min, th_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, surf_min, surf_max, back_min, back_max, data):
     init = [(r_min, r_max), (th_min, th_max), (inc_min, inc_max), (rot_min, rot_max), (x_m_min, x_m_max), (y_m_min, y_m_max), (surf_min, surf_max), (back_min, back_max)]   
     
-    params = scipy.optimize.differential_evolution(a_surf_score, init, args = (data,), popsize=50, tol=1e-5, polish=True)
+    with MP_CONTEXT.Pool() as pool:
+        params = scipy.optimize.differential_evolution(a_surf_score, init, args = (data,), popsize=50, tol=1e-5, polish=True, workers=pool.map, updating='deferred')
     print(params['x'])
     return params['x']
 
@@ -423,22 +817,23 @@ def a_surf_evo(r_min, r_max, th_min, th_max, inc_min, inc_max, rot_min, rot_max,
 ### Returns the score of the data minus a surface brightness annulus map.
 def a_gau_score(init, data):
     r, th, inc, rot, x_m, y_m, surf, back = init
-    score = 0
     map = test_map(r, th, inc, rot, x_m, y_m, surf, back, len(data))
-    for i in range (0, len(data)):
-        for j in range(0, len(data[0])):
-            score += np.sqrt((data[i,j] - map[i,j])**2)
-    return score
+    return _residual(data, map)
 
 ### OPTIMISED GAUSSIAN SURFACE BRIGHTNESS ANNULUS
 ### Performs an optimised algorithm search for the best fitting annulus
-### with a given surface brightness, in the range of parameters given.
-def a_gau_opt(r, th, inc, rot, x_m, y_m, surf, back, data):
+### with a given surface brightness, in the range of parameters given. If
+### plot is set, the annulus' centre line is drawn after every iteration.
+def a_gau_opt(r, th, inc, rot, x_m, y_m, surf, back, data, plot=False):
     init = (r, th, inc, rot, x_m, y_m, surf, back)
+    if plot:
+        callback = lambda xk: e_plot((xk[0], xk[2], xk[3], xk[4], xk[5]), 'k')
+    else:
+        callback = None
     # Finds the minimum difference between data and annulus
     params = scipy.optimize.minimize(a_gau_score, init, args = data,
                                      method = 'Powell', tol = 1e-5,
-                                     callback=e_plot((init[0], init[2], init[3], init[4], init[5]), 'k'),
+                                     callback=callback,
                                      options={'disp':True})
     print(params['x'])
     return params['x']
@@ -450,7 +845,8 @@ def a_gau_opt(r, th, inc, rot, x_m, y_m, surf, back, data):
 def a_gau_evo(r_min, r_max, th_min, th_max, inc_min, inc_max, rot_min, rot_max, x_m_min, x_m_max, y_m_min, y_m_max, surf_min, surf_max, back_min, back_max, data):
     init = [(r_min, r_max), (th_min, th_max), (inc_min, inc_max), (rot_min, rot_max), (x_m_min, x_m_max), (y_m_min, y_m_max), (surf_min, surf_max), (back_min, back_max)]   
     
-    params = scipy.optimize.differential_evolution(a_gau_score, init, args = (data,), popsize=10, polish=True)
+    with MP_CONTEXT.Pool() as pool:
+        params = scipy.optimize.differential_evolution(a_gau_score, init, args = (data,), popsize=10, polish=True, workers=pool.map, updating='deferred')
     print(params['x'])
     return params['x']
 
@@ -458,12 +854,8 @@ def a_gau_evo(r_min, r_max, th_min, th_max, inc_min, inc_max, rot_min, rot_max,
 ### Returns the score of the data minus a surface brightness annulus map.
 def a_mie_score(init, data):
     r, th, inc, rot, x_m, y_m, surf_0, surf_theta, theta_max, back = init
-    score = 0
     map = test_map_mie(r, th, inc, rot, x_m, y_m, surf_0, surf_theta, theta_max, back, len(data))
-    for i in range (0, len(data)):
-        for j in range(0, len(data[0])):
-            score += np.sqrt((data[i,j] - map[i,j])**2)
-    return score
+    return _residual(data, map)
 
 ### OPTIMISED GAUSSIAN SURFACE BRIGHTNESS ANNULUS WITH MIE
 ### Performs an optimised algorithm search for the best fitting annulus
@@ -480,12 +872,8 @@ def a_mie_opt(r, th, inc, rot, x_m, y_m, surf_0, surf_theta, theta_max, back, da
 ### Returns the score of the data minus a surface brightness annulus map.
 def a_hg_score(init, data):
     r, th, inc, rot, x_m, y_m, g, surf, back = init
-    score = 0
     map = hg_map(r, th, inc, rot, x_m, y_m, g, surf, back, len(data))
-    for i in range (0, len(data)):
-        for j in range(0, len(data[0])):
-            score += np.sqrt((data[i,j] - map[i,j])**2)
-    return score
+    return _residual(data, map)
 
 ### OPTIMISED HENYEY GREENSTEIN GAUSSIAN RING
 ### Performs an optimised algorithm search for the best fitting annulus
@@ -498,14 +886,26 @@ def a_hg_opt(r, th, inc, rot, x_m, y_m, g, surf, back, data):
     print(params['x'])
     return params['x']
 
+### ANNULUS DRAWING GRID
+### The points a_plot evaluates annuli on, built once rather than on every
+### drawing.
+A_PLOT_X, A_PLOT_Y = np.meshgrid(np.linspace(0, 282, 100), np.linspace(0, 282, 100))
+
 ### ANNULUS DRAWING
 ### Draws an annulus with these parameters and colour.
 def a_plot(r, th, inc, rot, x_m, y_m, col, alpha):
     
-    # Plotting the annulus
-    x_l = np.linspace(0, 282, 100)
-    y_l = np.linspace(0, 282, 100)
-    x, y = np.meshgrid(x_l,y_l)
+    # a_z squared is a quadratic form in the offsets from the centre, whose
+    # coefficients only depend on inc and rot
+    cos_inc = math.cos(math.radians(inc))
+    cos_rot = math.cos(math.radians(180 - rot))
+    sin_rot = math.sin(math.radians(180 - rot))
+    A = cos_rot*cos_rot + sin_rot*sin_rot/cos_inc
+    B = cos_rot*sin_rot*(1/cos_inc - 1)
+    C = sin_rot*sin_rot + cos_rot*cos_rot/cos_inc
     
-    z = a_z(x, y, inc, 180-rot, x_m, y_m)
-    plt.contourf(x, y, z, levels=[r - th/2, r + th/2], colors = col, alpha = alpha)
\ No newline at end of file
+    # Plotting the annulus
+    d_x = A_PLOT_X - x_m
+    d_y = A_PLOT_Y - y_m
+    z = np.sqrt(A*d_x*d_x + 2*B*d_x*d_y + C*d_y*d_y)
+    plt.contourf(A_PLOT_X, A_PLOT_Y, z, levels=[r - th/2, r + th/2], colors = col, alpha = alpha)